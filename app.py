@@ -1,11 +1,18 @@
-from flask import Flask, render_template, request, send_file, url_for
+from flask import (Flask, Response, get_template_attribute, jsonify,
+                   render_template, request, send_file, stream_with_context,
+                   url_for)
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import os
+import json
 import pandas as pd
 import time
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import joblib
 from .health_advice import generate_health_advice
 from dotenv import load_dotenv
@@ -26,6 +33,7 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 
 app = Flask(__name__)
 last_session = {}  # holds data for PDF export
+csv_lock = threading.Lock()  # serialises appends to predictions.csv
 
 # ─── Helpers ────────────────────────────────────────────────────────────────────
 def sigmoid(z):
@@ -63,13 +71,14 @@ Explain in 3 lines what this means for the person's heart health.
                 {"role":"user",  "content":prompt}
             ],
             max_tokens=150,
-            temperature=0.7
+            temperature=0.7,
+            request_timeout=EXPLANATION_TIMEOUT
         )
         return resp.choices[0].message["content"].strip()
     except Exception as e:
         return f"⚠️ Unable to generate explanation: {e}"
 
-def process_user_input(user_data):
+def score_user_input(user_data):
     if user_data["height"] <= 0 or user_data["weight"] <= 0:
         raise ValueError("Height and weight must be greater than zero.")
 
@@ -87,42 +96,61 @@ def process_user_input(user_data):
     elif bmi < 25:       bmi_cat = "Normal"
     elif bmi < 30:       bmi_cat = "Overweight"
     else:                bmi_cat = "Obese"
-
-    ts = int(time.time())
+    return prediction, bmi, bmi_cat
+
+# Plots use the object-oriented Figure API rather than pyplot so they can be
+# rendered from worker threads without sharing pyplot's global state.
+def draw_bmi_plot(bmi, bmi_cat, path):
+    fig = Figure(figsize=(6,2))
+    ax  = fig.add_subplot()
+    ax.axhline(1, xmin=0, xmax=4, color="gray", linewidth=12)
+    color = "green" if bmi<25 else "orange" if bmi<30 else "red"
+    ax.plot([bmi],[1],"o",color=color,markersize=18)
+    ax.set_yticks([]); ax.set_xticks([15,18.5,25,30,40])
+    ax.set_xticklabels(["15","18.5","25","30","40"])
+    ax.set_title(f"BMI: {bmi:.1f} ({bmi_cat})")
+    fig.tight_layout(); fig.savefig(path)
+    return path
+
+def draw_bp_plot(user_data, path):
+    fig = Figure(figsize=(5,3))
+    ax  = fig.add_subplot()
+    ax.bar(["Systolic","Diastolic"], [user_data["ap_hi"],user_data["ap_lo"]],
+           color=["skyblue","lightgreen"])
+    ax.axhline(120, color="blue", linestyle="--", label="Normal Systolic")
+    ax.axhline(80,  color="green", linestyle="--", label="Normal Diastolic")
+    ax.set_title("Your Blood Pressure"); ax.legend()
+    fig.tight_layout(); fig.savefig(path)
+    return path
+
+def plot_paths(tag):
     plot_dir = os.path.join(app.static_folder, "plots")
     os.makedirs(plot_dir, exist_ok=True)
-    bmi_png = os.path.join(plot_dir, f"bmi_{ts}.png")
-    bp_png  = os.path.join(plot_dir, f"bp_{ts}.png")
+    return (os.path.join(plot_dir, f"bmi_{tag}.png"),
+            os.path.join(plot_dir, f"bp_{tag}.png"))
 
-    # Draw BMI plot
-    plt.figure(figsize=(6,2))
-    plt.axhline(1, xmin=0, xmax=4, color="gray", linewidth=12)
-    color = "green" if bmi<25 else "orange" if bmi<30 else "red"
-    plt.plot([bmi],[1],"o",color=color,markersize=18)
-    plt.yticks([]); plt.xticks([15,18.5,25,30,40],["15","18.5","25","30","40"])
-    plt.title(f"BMI: {bmi:.1f} ({bmi_cat})")
-    plt.tight_layout(); plt.savefig(bmi_png); plt.close()
-
-    # Draw BP plot
-    plt.figure(figsize=(5,3))
-    plt.bar(["Systolic","Diastolic"], [user_data["ap_hi"],user_data["ap_lo"]],
-            color=["skyblue","lightgreen"])
-    plt.axhline(120, color="blue", linestyle="--", label="Normal Systolic")
-    plt.axhline(80,  color="green", linestyle="--", label="Normal Diastolic")
-    plt.title("Your Blood Pressure"); plt.legend()
-    plt.tight_layout(); plt.savefig(bp_png); plt.close()
+def save_prediction(row):
+    os.makedirs("data/retrieved", exist_ok=True)
+    with csv_lock:
+        pd.DataFrame([row]).to_csv(
+            "data/retrieved/predictions.csv",
+            mode="a",
+            header=not os.path.exists("data/retrieved/predictions.csv"),
+            index=False
+        )
+
+def process_user_input(user_data):
+    prediction, bmi, bmi_cat = score_user_input(user_data)
+
+    bmi_png, bp_png = plot_paths(int(time.time()))
+    draw_bmi_plot(bmi, bmi_cat, bmi_png)
+    draw_bp_plot(user_data, bp_png)
 
     explanation = generate_natural_explanation(user_data)
     adv_l, adv_r = generate_health_advice({**user_data,"bmi":bmi})
 
-    os.makedirs("data/retrieved", exist_ok=True)
     row = { **user_data, "prediction": prediction }
-    pd.DataFrame([row]).to_csv(
-        "data/retrieved/predictions.csv",
-        mode="a",
-        header=not os.path.exists("data/retrieved/predictions.csv"),
-        index=False
-    )
+    save_prediction(row)
 
     last_session.clear()
     last_session.update({
@@ -141,22 +169,171 @@ def process_user_input(user_data):
         adv_l, adv_r, explanation
     )
 
+# ─── Progressive Jobs ──────────────────────────────────────────────────────────
+# The progressive flow scores the input and builds advice synchronously, then
+# hands the charts, the LLM explanation and the CSV write to thread pools.
+# Charts get their own pool so slow OpenAI calls can never hold them up.
+# Each finished part is recorded on the job and announced through a Condition
+# so that SSE streams and polling clients can pick it up as soon as it lands.
+PROGRESSIVE_PARTS = ("plot_bmi", "plot_bp", "explanation")
+CHART_ALT         = {"plot_bmi": "BMI Chart", "plot_bp": "Blood Pressure Chart"}
+MAX_JOBS          = 200
+# Timing: everything a client waits for is bounded by the OpenAI timeout plus
+# some headroom for charts queued behind other jobs.
+EXPLANATION_TIMEOUT = 20   # seconds before the OpenAI request is abandoned
+CHART_GRACE         = 10   # seconds allowed for queued charts to render
+JOB_TIMEOUT         = EXPLANATION_TIMEOUT + CHART_GRACE  # stream/poll give-up
+PDF_PLOT_WAIT       = CHART_GRACE  # seconds the PDF export waits for charts
+POLL_INTERVAL       = 1    # seconds between JSON polls from the page
+KEEPALIVE_INTERVAL  = 5    # seconds between SSE comments on an idle stream
+
+plot_executor = ThreadPoolExecutor(max_workers=4)
+llm_executor  = ThreadPoolExecutor(max_workers=4)
+jobs      = OrderedDict()
+jobs_cond = threading.Condition()
+
+def _job_update(job_id, key, value):
+    with jobs_cond:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        job["parts"][key] = value
+        job["version"] += 1
+        job["done"] = all(p in job["parts"] for p in PROGRESSIVE_PARTS)
+        if key == "explanation" and last_session.get("job_id") == job_id:
+            last_session["explanation"] = value
+        jobs_cond.notify_all()
+
+def _run_part(job_id, key, fn, *args):
+    try:
+        value = fn(*args)
+    except Exception as e:
+        value = None
+        app.logger.warning("Progressive job %s: %s failed: %s", job_id, key, e)
+    if key.startswith("plot_") and value:
+        value = f"plots/{os.path.basename(value)}"
+    _job_update(job_id, key, value)
+
+def _save_in_background(job_id, row):
+    try:
+        save_prediction(row)
+    except Exception as e:
+        app.logger.warning("Progressive job %s: saving prediction failed: %s", job_id, e)
+
+def score_progressive_job(user_data):
+    """Run the synchronous part of a progressive job; nothing is stored yet."""
+    prediction, bmi, bmi_cat = score_user_input(user_data)
+    adv_l, adv_r = generate_health_advice({**user_data,"bmi":bmi})
+    return {
+        "user_data":    user_data,
+        "prediction":   prediction,
+        "bmi":          bmi,
+        "bmi_cat":      bmi_cat,
+        "advice_left":  adv_l,
+        "advice_right": adv_r,
+    }
+
+def start_progressive_job(scored):
+    """Register a scored job and queue its charts, explanation and CSV row."""
+    user_data  = scored["user_data"]
+    prediction = scored["prediction"]
+    bmi, bmi_cat = scored["bmi"], scored["bmi_cat"]
+    adv_l, adv_r = scored["advice_left"], scored["advice_right"]
+    row = { **user_data, "prediction": prediction }
+
+    job_id = uuid.uuid4().hex
+    bmi_png, bp_png = plot_paths(job_id)
+    with jobs_cond:
+        jobs[job_id] = {
+            "prediction":   prediction,
+            "advice_left":  adv_l,
+            "advice_right": adv_r,
+            "parts":        {},
+            "version":      0,
+            "done":         False,
+        }
+        while len(jobs) > MAX_JOBS:
+            jobs.popitem(last=False)
+
+        last_session.clear()
+        last_session.update({
+            "job_id":       job_id,
+            "user_data":    row,
+            "explanation":  None,
+            "plot_bmi":     bmi_png,
+            "plot_bp":      bp_png,
+            "advice_left":  adv_l,
+            "advice_right": adv_r
+        })
+
+    plot_executor.submit(_run_part, job_id, "plot_bmi", draw_bmi_plot, bmi, bmi_cat, bmi_png)
+    plot_executor.submit(_run_part, job_id, "plot_bp", draw_bp_plot, user_data, bp_png)
+    plot_executor.submit(_save_in_background, job_id, row)
+    llm_executor.submit(_run_part, job_id, "explanation", generate_natural_explanation, user_data)
+    return job_id
+
+def job_snapshot(job_id):
+    with jobs_cond:
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        return {
+            "job_id":       job_id,
+            "prediction":   job["prediction"],
+            "advice_left":  job["advice_left"],
+            "advice_right": job["advice_right"],
+            "parts":        dict(job["parts"]),
+            "done":         job["done"],
+        }
+
+def wait_for_plots(job_id, timeout):
+    """Block until the job's charts are finished (or timeout) and return the
+    finished chart parts, or None if the job is no longer tracked."""
+    with jobs_cond:
+        jobs_cond.wait_for(
+            lambda: job_id not in jobs
+                    or all(k in jobs[job_id]["parts"] for k in CHART_ALT),
+            timeout=timeout)
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        return {k: job["parts"].get(k) for k in CHART_ALT}
+
+def _part_payload(key, value):
+    # Rendered from the same macros as the full-page result panel
+    if key == "explanation":
+        html = get_template_attribute("result_macros.html", "explanation_body")(value)
+    else:
+        html = get_template_attribute("result_macros.html", "chart_body")(value, CHART_ALT[key])
+    return {"part": key, "html": str(html)}
+
+def _unknown_job():
+    # Distinct from a finished job: the parts may well exist, this process
+    # just has no record of them.
+    return jsonify({
+        "error":   "Unknown or expired job.",
+        "expired": True,
+        "html":    str(get_template_attribute("result_macros.html", "part_expired")())
+    }), 404
+
+def read_user_form(f):
+    getf = lambda k,d: float(f.get(k) or d)
+    return {
+        "age":getf("age",0), "gender":getf("gender",1),
+        "height":getf("height",0), "weight":getf("weight",0),
+        "ap_hi":getf("ap_hi",0), "ap_lo":getf("ap_lo",0),
+        "cholesterol":getf("cholesterol",1), "gluc":getf("gluc",1),
+        "smoke":getf("smoke",0), "alco":getf("alco",0),
+        "active":getf("active",1)
+    }
+
 # ─── Flask Routes ──────────────────────────────────────────────────────────────
 @app.route("/", methods=["GET","POST"])
 def index():
     error = None
     if request.method=="POST":
         try:
-            f    = request.form
-            getf = lambda k,d: float(f.get(k) or d)
-            user_data = {
-                "age":getf("age",0), "gender":getf("gender",1),
-                "height":getf("height",0), "weight":getf("weight",0),
-                "ap_hi":getf("ap_hi",0), "ap_lo":getf("ap_lo",0),
-                "cholesterol":getf("cholesterol",1), "gluc":getf("gluc",1),
-                "smoke":getf("smoke",0), "alco":getf("alco",0),
-                "active":getf("active",1)
-            }
+            user_data = read_user_form(request.form)
             vals = process_user_input(user_data)
             return render_template("index.html",
                                    prediction   = vals[0],
@@ -169,6 +346,77 @@ def index():
             error = str(e)
     return render_template("index.html", error=error, prediction=None)
 
+@app.route("/predict/progressive", methods=["POST"])
+def predict_progressive():
+    # Render before the job is started so a template error cannot leave a
+    # stored prediction behind a failed response.
+    try:
+        user_data = read_user_form(request.form)
+        scored    = score_progressive_job(user_data)
+        html      = render_template("result_panel.html",
+                                    progressive  = True,
+                                    prediction   = scored["prediction"],
+                                    advice_left  = scored["advice_left"],
+                                    advice_right = scored["advice_right"])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        job_id = start_progressive_job(scored)
+    except Exception as e:
+        app.logger.warning("Progressive job could not be started: %s", e)
+        return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "job_id":       job_id,
+        "prediction":   scored["prediction"],
+        "html":         html,
+        "parts":        list(PROGRESSIVE_PARTS),
+        "timeout":      JOB_TIMEOUT,
+        "poll_interval": POLL_INTERVAL,
+        "stream_url":   url_for("progress_stream", job_id=job_id),
+        "poll_url":     url_for("progress_poll", job_id=job_id)
+    })
+
+@app.route("/progress/<job_id>")
+def progress_poll(job_id):
+    snap = job_snapshot(job_id)
+    if snap is None:
+        return _unknown_job()
+    snap["parts"] = [_part_payload(k, v) for k, v in snap["parts"].items()]
+    return jsonify(snap)
+
+@app.route("/progress/<job_id>/stream")
+def progress_stream(job_id):
+    if job_snapshot(job_id) is None:
+        return _unknown_job()
+
+    def events():
+        sent     = set()
+        deadline = time.time() + JOB_TIMEOUT
+        while True:
+            with jobs_cond:
+                jobs_cond.wait_for(
+                    lambda: job_id not in jobs
+                            or set(jobs[job_id]["parts"]) - sent
+                            or time.time() >= deadline,
+                    timeout=max(0, min(KEEPALIVE_INTERVAL, deadline - time.time())))
+                job = jobs.get(job_id)
+                fresh = {k: v for k, v in job["parts"].items() if k not in sent} if job else {}
+                done  = job is None or job["done"]
+            for k, v in fresh.items():
+                sent.add(k)
+                yield f"event: part\ndata: {json.dumps(_part_payload(k, v))}\n\n"
+            if done or time.time() >= deadline:
+                yield "event: done\ndata: {}\n\n"
+                return
+            if not fresh:
+                # Writing something regularly is how a closed client is
+                # detected, which frees this thread instead of idling on.
+                yield ": keepalive\n\n"
+    return Response(stream_with_context(events()),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
 @app.route("/download_pdf")
 def download_pdf():
     if not last_session:
@@ -180,6 +428,15 @@ def download_pdf():
     bmi_p   = last_session["plot_bmi"]
     bp_p    = last_session["plot_bp"]
 
+    # Charts from a progressive job may still be drawing; only use the ones
+    # a worker has finished writing so ImageReader never sees a partial PNG.
+    job_id = last_session.get("job_id")
+    if job_id:
+        ready = wait_for_plots(job_id, PDF_PLOT_WAIT)
+        if ready is not None:
+            if not ready["plot_bmi"]: bmi_p = None
+            if not ready["plot_bp"]:  bp_p  = None
+
     # Prepare PDF
     pdf_dir = os.path.join(app.static_folder, "pdf")
     os.makedirs(pdf_dir, exist_ok=True)
@@ -230,12 +487,12 @@ def download_pdf():
     chart_x = margin_x + col_w + gutter
     bmi_h   = 35 * mm
     bmi_y   = top_y - bmi_h
-    if os.path.exists(bmi_p):
+    if bmi_p and os.path.exists(bmi_p):
         c.drawImage(ImageReader(os.path.join(app.static_folder, bmi_p)),
                     chart_x, bmi_y, col_w, bmi_h, mask="auto")
     bp_h    = 35 * mm
     bp_y    = bmi_y - bp_h - 5*mm
-    if os.path.exists(bp_p):
+    if bp_p and os.path.exists(bp_p):
         c.drawImage(ImageReader(os.path.join(app.static_folder, bp_p)),
                     chart_x, bp_y, col_w, bp_h, mask="auto")
 